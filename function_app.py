@@ -1,24 +1,65 @@
 import os
+import asyncio
+import functools
+import math
+from hashlib import blake2b
+from datetime import datetime, timedelta, timezone
 import azure.functions as func
 import logging
-from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import AzureError, ResourceExistsError, ResourceNotFoundError
+from azure.storage.blob import BlobSasPermissions, generate_blob_sas
+from azure.storage.blob.aio import BlobServiceClient
+from cachetools import TTLCache
 from PIL import Image
+from cykooz_resizer import FilterType, ResizeAlg, ResizeOptions, Resizer
 import io
 
+try:
+    import pyvips
+except (ImportError, OSError):
+    # libvips is not installed on this worker; every transform goes through PIL
+    pyvips = None
+
+log = logging.getLogger(__name__)
+
 # Initialize BlobServiceClient and container clients
 connection_string = os.getenv("AZURE_STORAGE_CONNECTION_STRING")
 if not connection_string:
     raise ValueError("AZURE_STORAGE_CONNECTION_STRING environment variable is not set")
 
-blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+# Larger transfer sizes mean fewer ranged requests per blob; the client's pipeline and connection pool are shared by all requests
+blob_service_client = BlobServiceClient.from_connection_string(
+    connection_string,
+    max_single_get_size=16 * 1024 * 1024,
+    max_chunk_get_size=8 * 1024 * 1024,
+    max_single_put_size=64 * 1024 * 1024,
+    connection_timeout=10
+)
 assets_container_client = blob_service_client.get_container_client("assets")
 output_container_client = blob_service_client.get_container_client("assetsoutput")
 
-# Ensure the output container exists
-try:
-    output_container_client.create_container()
-except Exception as e:
-    logging.info(f"Container 'assetsoutput' already exists or could not be created: {e}")
+# Uploads run in the background after the response is returned; keep references so they are not garbage collected
+background_tasks = set()
+
+# Cache blob clients by name; constructing one parses the URL and builds a new pipeline
+@functools.lru_cache(maxsize=1024)
+def get_assets_blob_client(blob_name):
+    return assets_container_client.get_blob_client(blob=blob_name)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_output_blob_client(blob_name):
+    return output_container_client.get_blob_client(blob=blob_name)
+
+
+# In-process cache of transformed images, keyed by output filename and bounded by total bytes;
+# the worker process is reused across invocations, so repeat requests skip Blob Storage entirely
+transformed_cache = TTLCache(maxsize=128 * 1024 * 1024, ttl=600, getsizeof=lambda entry: len(entry[0]))
+
+# Requests without transform parameters are redirected to the original blob; the redirect may be cached
+# for a fraction of the SAS lifetime so cached redirects never point at an expired URL
+SAS_LIFETIME = timedelta(hours=1)
+REDIRECT_MAX_AGE = 300
 
 # Mapping of file extensions to MIME types
 MIME_TYPES = {
@@ -29,16 +70,220 @@ MIME_TYPES = {
     "GIF": "image/gif"
 }
 
+# Formats the transformed image can be saved as
+SUPPORTED_FORMATS = frozenset({"JPEG", "PNG", "BMP", "GIF"})
+
+# Upper bound for requested width and height, so a single request cannot make PIL allocate an enormous image
+MAX_DIMENSION = 8192
+
+# Encoder settings per format, favouring encode speed over the last few percent of file size
+SAVE_KWARGS = {
+    "JPEG": {"quality": 85, "optimize": False, "progressive": False},
+    "PNG": {"compress_level": 1},
+    "BMP": {},
+    "GIF": {"optimize": False}
+}
+
+# SIMD resizer (fast_image_resize) shared by all requests; CPU extensions are auto-detected
+resizer = Resizer()
+
+# Resampling filters selected by the 'quality' parameter, for the SIMD resizer and the PIL fallback
+RESIZE_QUALITIES = {
+    "low": (ResizeOptions(resize_alg=ResizeAlg.nearest()), Image.Resampling.NEAREST),
+    "medium": (ResizeOptions(resize_alg=ResizeAlg.convolution(FilterType.bilinear)), Image.Resampling.BILINEAR),
+    "high": (ResizeOptions(resize_alg=ResizeAlg.convolution(FilterType.lanczos3)), Image.Resampling.LANCZOS)
+}
+DEFAULT_QUALITY = "high"
+
+# PIL modes the resizer can handle; anything else (e.g. palette GIFs) falls back to PIL
+RESIZER_MODES = ("RGB", "RGBA", "CMYK", "I", "F", "L")
+
+# Large JPEG/PNG sources are resized with libvips, which streams the image instead of decoding it fully.
+# Metadata (EXIF, ICC) is stripped on save, as the PIL path does, so both paths produce the same output
+VIPS_MIN_SOURCE_SIZE = 2000
+VIPS_STRIP = "keep=none" if pyvips and pyvips.at_least_libvips(8, 15) else "strip"
+VIPS_SAVE_SUFFIXES = {
+    "JPEG": f".jpg[Q=85,{VIPS_STRIP}]",
+    "PNG": f".png[compression=1,{VIPS_STRIP}]"
+}
+
+
+def round_aspect(number, key):
+    """Round to whichever neighbouring integer (at least 1) minimises key, as Image.thumbnail does."""
+    return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+
+def thumbnail_size(size, box):
+    """Return the size PIL's thumbnail() would produce: fit within box, keep aspect ratio, never upscale."""
+    original_width, original_height = size
+    box_width, box_height = box
+    if box_width >= original_width and box_height >= original_height:
+        return size
+    aspect = original_width / original_height
+    if box_width / box_height >= aspect:
+        return (round_aspect(box_height * aspect, key=lambda n: abs(aspect - n / box_height)), box_height)
+    return (box_width, round_aspect(box_width / aspect, key=lambda n: 0 if n == 0 else abs(aspect - box_width / n)))
+
+
+def resize_image(image, target_size, quality):
+    """Resize the image to target_size using the SIMD resizer."""
+    if target_size == image.size:
+        return image
+    resize_options, resample = RESIZE_QUALITIES[quality]
+    if image.mode not in RESIZER_MODES:
+        return image.resize(target_size, resample)
+    resized = Image.new(image.mode, target_size)
+    resizer.resize_pil(image, resized, resize_options)
+    return resized
+
+
+def vips_transform(blob_data, target_size, format):
+    """Shrink-on-load, resize to exactly target_size and encode in a single libvips pipeline."""
+    width, height = target_size
+    image = pyvips.Image.thumbnail_buffer(blob_data, width, height=height, size="force", no_rotate=True)
+    return image.write_to_buffer(VIPS_SAVE_SUFFIXES[format])
+
+
+def transform_image(blob_stream, width, height, format, quality):
+    """Resize the image according to parameters, avoiding upscaling, and encode it in the given format."""
+    image = Image.open(blob_stream)
+    original_width, original_height = image.size
+
+    # Work out the target box first so JPEG decoding can already scale down towards it
+    if width and not height:
+        height = int(original_height * (width / original_width))
+    elif height and not width:
+        width = int(original_width * (height / original_height))
+
+    if width or height:
+        # Size the output from the full-resolution dimensions, as thumbnail() did, before draft() shrinks them;
+        # every resize path uses this size so output does not depend on which path ran
+        target_size = thumbnail_size(image.size, (width, height))
+
+        # libvips picks its own kernel, so only the default quality is routed through it
+        if (pyvips and quality == DEFAULT_QUALITY and image.format in VIPS_SAVE_SUFFIXES and format in VIPS_SAVE_SUFFIXES
+                and max(image.size) > VIPS_MIN_SOURCE_SIZE):
+            with blob_stream.getbuffer() as blob_data:
+                return vips_transform(blob_data, target_size, format)
+
+        # Let libjpeg downscale by 1/2, 1/4 or 1/8 during decoding; no-op for other formats
+        if image.format == "JPEG":
+            image.draft(image.mode, (width or 1, height or 1))
+        # Resize the image according to parameters, avoiding upscaling
+        image = resize_image(image, target_size, quality)
+
+    output = io.BytesIO()
+    image.save(output, format=format, **SAVE_KWARGS[format])
+    return output.getvalue()
+
+
+def cache_transformed_image(cache_key, data, mimetype):
+    """Remember a transformed image in memory; images larger than the whole cache are skipped."""
+    if len(data) <= transformed_cache.maxsize:
+        transformed_cache[cache_key] = (data, mimetype)
+
+
+def transformed_image_response(data, mimetype, download_filename, placeholder=False):
+    """Build the response for a transformed image; CDNs and browsers may cache it for a day.
+
+    A placeholder (the default image served for a missing source) must not be cached, or it would outlive
+    the upload of the real image.
+    """
+    return func.HttpResponse(
+        data,
+        mimetype=mimetype,
+        headers={
+            "Content-Disposition": f"inline; filename={download_filename}",
+            "Content-Length": str(len(data)),
+            "Cache-Control": "no-store" if placeholder else "public, max-age=86400"
+        }
+    )
+
+
+async def download_to_stream(blob_client):
+    """Download a blob straight into a BytesIO using parallel ranged GETs, without an intermediate bytes copy."""
+    stream = io.BytesIO()
+    downloader = await blob_client.download_blob(max_concurrency=4)
+    await downloader.readinto(stream)
+    stream.seek(0)
+    return stream
+
+
+async def original_blob_url(filename):
+    """Return a short-lived read-only SAS URL for a source blob, or None when it cannot be signed or checked."""
+    account_key = getattr(blob_service_client.credential, "account_key", None)
+    if not account_key:
+        return None
+
+    blob_client = get_assets_blob_client(filename)
+    try:
+        await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        log.info("Blob not found: %s. Using default image.", filename)
+        blob_client = get_assets_blob_client("no-image.jpg")
+    except AzureError as e:
+        # Fall back to downloading and returning the image ourselves
+        log.warning("Error checking blob %s for redirect: %s", filename, e)
+        return None
+
+    sas_token = generate_blob_sas(
+        account_name=blob_client.account_name,
+        container_name=blob_client.container_name,
+        blob_name=blob_client.blob_name,
+        account_key=account_key,
+        permission=BlobSasPermissions(read=True),
+        expiry=datetime.now(timezone.utc) + SAS_LIFETIME
+    )
+    return f"{blob_client.url}?{sas_token}"
+
+
+async def download_existing_blob(blob_client):
+    """Return the blob's content, or None if it does not exist or cannot be read; the HEAD probe avoids a GET on a miss."""
+    try:
+        await blob_client.get_blob_properties()
+        return await (await blob_client.download_blob()).readall()
+    except ResourceNotFoundError:
+        return None
+    except AzureError as e:
+        # Treat a failed probe as a cache miss; the image is transformed again instead of failing the request
+        log.warning("Error reading blob %s, treating it as missing: %s", blob_client.blob_name, e)
+        return None
+
+
+def discard_task(task):
+    """Cancel a task whose result is no longer needed, without warnings about unretrieved exceptions."""
+    task.cancel()
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+
+async def upload_output_blob(output_blob_client, data):
+    """Upload a transformed image, creating the output container on first use."""
+    try:
+        try:
+            await output_blob_client.upload_blob(data, overwrite=True, max_concurrency=8)
+        except ResourceNotFoundError:
+            log.info("Container 'assetsoutput' does not exist. Creating it.")
+            try:
+                await output_container_client.create_container()
+            except ResourceExistsError:
+                # Another worker created it in the meantime
+                pass
+            await output_blob_client.upload_blob(data, overwrite=True, max_concurrency=8)
+    except AzureError as e:
+        log.error("Error uploading transformed image %s: %s", output_blob_client.blob_name, e)
+
+
 app = func.FunctionApp(http_auth_level=func.AuthLevel.FUNCTION)
 
 @app.route(route="dynamicmediahandler")
-def dynamicmediahandler(req: func.HttpRequest) -> func.HttpResponse:
-    logging.info('Python HTTP trigger function processed a request.')
+async def dynamicmediahandler(req: func.HttpRequest) -> func.HttpResponse:
+    log.info('Python HTTP trigger function processed a request.')
 
     filename = req.params.get('filename')
     width = req.params.get('width')
     height = req.params.get('height')
     format = req.params.get('format')
+    quality = req.params.get('quality', DEFAULT_QUALITY).lower()
 
     if not filename:
         return func.HttpResponse(
@@ -46,126 +291,161 @@ def dynamicmediahandler(req: func.HttpRequest) -> func.HttpResponse:
             status_code=400
         )
 
+    if quality not in RESIZE_QUALITIES:
+        return func.HttpResponse(
+            "Unsupported quality.",
+            status_code=400
+        )
+
+    # Validate the requested dimensions before any download
+    try:
+        width = int(width) if width else None
+        height = int(height) if height else None
+    except ValueError:
+        return func.HttpResponse(
+            "Width and height must be integers.",
+            status_code=400
+        )
+    if any(size is not None and not 0 < size <= MAX_DIMENSION for size in (width, height)):
+        return func.HttpResponse(
+            f"Width and height must be between 1 and {MAX_DIMENSION}.",
+            status_code=400
+        )
+
     # Check if the filename has an extension
     if '.' not in filename:
-        logging.info(f"Filename does not have an extension. Using default image.")
+        log.info("Filename does not have an extension. Using default image.")
         filename = "no-image.jpg"
 
     # Determine the MIME type based on the file extension
-    original_extension = filename.split('.')[-1].upper()
+    stem, _, extension = filename.rpartition('.')
+    original_extension = extension.upper()
     mimetype = MIME_TYPES.get(original_extension, "application/octet-stream")
 
-    # Generate the output filename
-    output_filename = f"{filename.split('.')[0]}_{width}_{height}.{format.lower() if format else original_extension.lower()}"
+    # Without resizing, converting to the format the image already has would only decode and re-encode it
+    source_format = "JPEG" if original_extension == "JPG" else original_extension
+    requested_format = format.upper() if format else source_format
+    if requested_format == "JPG":
+        requested_format = "JPEG"
+    passthrough = not width and not height and requested_format == source_format
 
-    # Check if the transformed image already exists in the output container
-    output_blob_client = output_container_client.get_blob_client(blob=output_filename)
-    try:
-        output_blob_data = output_blob_client.download_blob().readall()
-        logging.info(f"Transformed image already exists: {output_filename}")
+    # Reject unsupported formats before any download
+    if not passthrough and requested_format not in SUPPORTED_FORMATS:
         return func.HttpResponse(
-            output_blob_data,
-            mimetype=MIME_TYPES.get(format.upper() if format else original_extension, "application/octet-stream"),
-            headers={
-                "Content-Disposition": f"inline; filename={output_filename}"
-            }
+            "Unsupported format.",
+            status_code=400
         )
-    except Exception:
-        logging.info(f"Transformed image does not exist: {output_filename}. Proceeding with transformation.")
 
-    # Attempt to download the original image from the assets container
-    blob_client = assets_container_client.get_blob_client(blob=filename)
+    # Generate the output filename from a hash of the source filename and the canonical transform parameters,
+    # so equivalent requests (e.g. format=jpg and format=jpeg) share one name. Quality only selects the resize
+    # filter, so it is left out when there is nothing to resize
+    format_extension = "jpg" if requested_format == "JPEG" else requested_format.lower()
+    resize_quality = quality if width or height else ""
+    transform_key = blake2b(f"{filename}|{width}|{height}|{requested_format}|{resize_quality}".encode(), digest_size=8).hexdigest()
+    output_filename = f"{stem}/{transform_key}.{format_extension}"
+    download_filename = f"{stem.rpartition('/')[2]}.{format_extension}"
+
+    # If no transformation is needed, let Blob Storage serve the existing image directly
+    if passthrough:
+        blob_url = await original_blob_url(filename)
+        if blob_url:
+            return func.HttpResponse(
+                status_code=302,
+                headers={
+                    "Location": blob_url,
+                    "Cache-Control": f"public, max-age={REDIRECT_MAX_AGE}"
+                }
+            )
+
+    # Serve repeat requests for the same transformation from memory; pass-through requests are never cached
+    cache_key = output_filename
+    cached = None if passthrough else transformed_cache.get(cache_key)
+    if cached:
+        output_data, output_mimetype = cached
+        return transformed_image_response(output_data, output_mimetype, download_filename)
+
+    # Start downloading the original image while checking whether the transformed image already exists,
+    # so a cache miss does not pay for the two round trips one after the other
+    blob_client = get_assets_blob_client(filename)
+    log.info("Attempting to download blob: %s from container: assets", filename)
+    source_task = asyncio.create_task(download_to_stream(blob_client))
+
+    # Check if the transformed image already exists in the output container; nothing is stored for pass-through
+    if not passthrough:
+        output_blob_client = get_output_blob_client(output_filename)
+        try:
+            output_blob_data = await download_existing_blob(output_blob_client)
+        except BaseException:
+            discard_task(source_task)
+            raise
+        if output_blob_data is None:
+            log.info("Transformed image does not exist: %s. Proceeding with transformation.", output_filename)
+        else:
+            discard_task(source_task)
+            log.info("Transformed image already exists: %s", output_filename)
+            output_mimetype = MIME_TYPES.get(requested_format, "application/octet-stream")
+            cache_transformed_image(cache_key, output_blob_data, output_mimetype)
+            return transformed_image_response(output_blob_data, output_mimetype, download_filename)
+
+    # Wait for the original image from the assets container
+    used_default_image = False
     try:
-        logging.info(f"Attempting to download blob: {filename} from container: assets")
-        blob_data = blob_client.download_blob().readall()
-        logging.info(f"Successfully downloaded blob: {filename}")
-    except Exception as e:
-        logging.error(f"Error downloading blob: {e}. Using default image.")
+        blob_stream = await source_task
+        log.info("Successfully downloaded blob: %s", filename)
+    except ResourceNotFoundError:
+        log.info("Blob not found: %s. Using default image.", filename)
         # Use default image if the specified image is not found
         default_filename = "no-image.jpg"
-        blob_client = assets_container_client.get_blob_client(blob=default_filename)
+        blob_client = get_assets_blob_client(default_filename)
         try:
-            blob_data = blob_client.download_blob().readall()
-            logging.info(f"Successfully downloaded default image: {default_filename}")
+            blob_stream = await download_to_stream(blob_client)
+            log.info("Successfully downloaded default image: %s", default_filename)
             # Update filename to default filename for further processing
             filename = default_filename
-        except Exception as e:
-            logging.error(f"Error downloading default image: {e}")
+            used_default_image = True
+        except AzureError as e:
+            log.error("Error downloading default image: %s", e)
             return func.HttpResponse(
                 "Error downloading the image.",
                 status_code=500
             )
-
-    # If width, height, and format are not provided, return the existing image
-    if not width and not height and not format:
+    except AzureError as e:
+        log.error("Error downloading blob: %s", e)
         return func.HttpResponse(
-            blob_data,
-            mimetype=mimetype
+            "Error downloading the image.",
+            status_code=500
         )
 
-    # Transform the image based on the input criteria
-    try:
-        image = Image.open(io.BytesIO(blob_data))
-        logging.info(f"Original image size: {image.size}")
-        original_width, original_height = image.size
-
-        # Resize the image according to parameters, avoiding upscaling
-        if width and height:
-            width = int(width)
-            height = int(height)
-            image.thumbnail((width, height))
-        elif width:
-            width = int(width)
-            height = int(original_height * (width / original_width))
-            image.thumbnail((width, height))
-        elif height:
-            height = int(height)
-            width = int(original_width * (height / original_height))
-            image.thumbnail((width, height))
-        logging.info(f"Transformed image size: {image.size}")
-
-        # Determine the format for saving
-        if format:
-            format = format.upper()
-            if format == "JPG":
-                format = "JPEG"
-            if format not in ["JPEG", "PNG", "BMP", "GIF"]:
-                return func.HttpResponse(
-                    "Unsupported format.",
-                    status_code=400
-                )
-        else:
-            # Use the format of the original file extension
-            if original_extension == "JPG":
-                format = "JPEG"
-            elif original_extension in ["JPEG", "PNG", "BMP", "GIF"]:
-                format = original_extension
-            else:
-                return func.HttpResponse(
-                    "Unsupported format.",
-                    status_code=400
-                )
-
-        output = io.BytesIO()
-        image.save(output, format=format)
-        output.seek(0)
-
-        # Upload the transformed image to the output container
-        output_blob_client.upload_blob(output, overwrite=True)
-
-        # Return the transformed image with the correct filename
-        output.seek(0)
+    # If no transformation is needed, return the existing image (no account key to sign a redirect)
+    if passthrough:
         return func.HttpResponse(
-            output.read(),
-            mimetype=MIME_TYPES.get(format, "application/octet-stream"),
-            headers={
-                "Content-Disposition": f"inline; filename={output_filename}"
-            }
+            blob_stream.getvalue(),
+            # The default image is a JPEG whatever extension was requested
+            mimetype=MIME_TYPES["JPEG"] if used_default_image else mimetype
         )
 
+    # Transform the image based on the input criteria, off the event loop since it is CPU bound
+    try:
+        data = await asyncio.to_thread(transform_image, blob_stream, width, height, requested_format, quality)
     except Exception as e:
-        logging.error(f"Error processing image: {e}")
+        log.error("Error processing image: %s", e)
         return func.HttpResponse(
             "Error processing the image.",
             status_code=500
-        )
\ No newline at end of file
+        )
+
+    output_mimetype = MIME_TYPES.get(requested_format, "application/octet-stream")
+
+    # The default image stands in for a missing source; keep it out of the caches under the real request's name
+    if used_default_image:
+        return transformed_image_response(data, output_mimetype, download_filename, placeholder=True)
+
+    cache_transformed_image(cache_key, data, output_mimetype)
+
+    # Upload the transformed image to the output container without delaying the response
+    upload_task = asyncio.create_task(upload_output_blob(output_blob_client, data))
+    background_tasks.add(upload_task)
+    upload_task.add_done_callback(background_tasks.discard)
+
+    # Return the transformed image with the correct filename
+    return transformed_image_response(data, output_mimetype, download_filename)